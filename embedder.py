@@ -0,0 +1,22 @@
+import os
+import functools
+import torch
+from chromadb.utils import embedding_functions
+
+# CPU inference only: split the cores between the server's worker processes so they
+# don't oversubscribe them, and never track gradients (grad mode is per-thread,
+# sentence-transformers' encode() already runs under inference_mode in worker threads)
+_DEFAULT_NUM_THREADS = max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1")))
+torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", _DEFAULT_NUM_THREADS)))
+torch.set_grad_enabled(False)
+
+# Model shared by the property and FAQ collections
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+@functools.lru_cache(maxsize=1)
+def get_embedder(model_name: str = EMBEDDING_MODEL_NAME):
+    """
+    Return a process-wide SentenceTransformer embedding function.
+    Loading the model once keeps every caller on the same weights.
+    """
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name)
@@ -0,0 +1,58 @@
+import re
+from typing import List, Optional
+
+# Sent when a message can't be answered
+ERROR_MESSAGE = "Sorry, I'm having trouble processing your request. Please try again."
+
+# This regex is simple and effective for this use case.
+_URL_RE = re.compile(r'https?://\S+')
+
+def extract_url_from_text(text: str) -> Optional[str]:
+    """Finds the first HTTP or HTTPS URL in a string."""
+    # Cheap substring check skips the regex for the vast majority of replies
+    if "http" not in text:
+        return None
+    match = _URL_RE.search(text)
+    return match.group(0) if match else None
+
+def split_message(text: str, limit: int = 1600) -> List[str]:
+    """
+    Splits a long message into multiple chunks under the character limit,
+    preferring to split at newlines.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    # One long paragraph: nothing to split on, so slice it directly
+    if '\n' not in text:
+        text = text.strip()
+        return [text[i:i + limit] for i in range(0, max(len(text), 1), limit)]
+
+    chunks = []
+    current_lines = []
+    current_len = 0
+
+    for line in text.split('\n'):
+        line_len = len(line) + 1
+        # A line that can't share a chunk is emitted on its own, split by force if over the limit
+        if line_len > limit:
+            if current_lines:
+                chunks.append("\n".join(current_lines).strip())
+                current_lines = []
+                current_len = 0
+            line = line.strip()
+            chunks.extend(line[i:i + limit] for i in range(0, max(len(line), 1), limit))
+        # If adding the next line (plus a newline character) exceeds the limit
+        elif current_lines and current_len + line_len > limit:
+            chunks.append("\n".join(current_lines).strip())
+            current_lines = [line]
+            current_len = line_len
+        else:
+            current_lines.append(line)
+            current_len += line_len
+    
+    # Add the last remaining chunk
+    if current_lines:
+        chunks.append("\n".join(current_lines).strip())
+
+    return chunks
@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+from typing import Optional
+from cachetools import TTLCache
+from shared_state import redis_client
+
+# Recent replies, so Twilio's webhook retries don't run the agent twice
+REPLY_CACHE_TTL = 120
+_reply_cache = TTLCache(maxsize=4096, ttl=REPLY_CACHE_TTL)
+# Cached in place of the reply while the first request for a message is still running
+_PENDING_REPLY = "pending"
+# How long a retry waits for the first request's reply (Twilio times out after 15s).
+# If it isn't ready by then, the first request sends it through the REST API.
+REPLY_WAIT_TIMEOUT = 10
+
+def reply_cache_key(message_sid: Optional[str], session_id: str, message_body: str) -> str:
+    """Twilio's MessageSid identifies retries exactly; fall back to hashing sender + body."""
+    if message_sid:
+        return message_sid
+    return hashlib.blake2b(f"{session_id}|{message_body}".encode(), digest_size=16).hexdigest()
+
+async def get_cached_reply(cache_key: str) -> Optional[str]:
+    if redis_client is not None:
+        cached = await asyncio.to_thread(redis_client.get, f"reply:{cache_key}")
+        return cached.decode() if cached is not None else None
+    return _reply_cache.get(cache_key)
+
+async def claim_reply(cache_key: str) -> bool:
+    """
+    Mark a message as being answered. False if another request already claimed it,
+    so a retry arriving mid-turn doesn't run the agent a second time.
+    """
+    # Shared through Redis when several workers may receive the retry
+    if redis_client is not None:
+        claimed = await asyncio.to_thread(
+            redis_client.set, f"reply:{cache_key}", _PENDING_REPLY, ex=REPLY_CACHE_TTL, nx=True
+        )
+        return bool(claimed)
+    # No await between the check and the set, so this is atomic on the event loop
+    if cache_key in _reply_cache:
+        return False
+    _reply_cache[cache_key] = _PENDING_REPLY
+    return True
+
+async def release_reply(cache_key: str):
+    """Drop a claim whose turn failed, so a later retry can run it again."""
+    if redis_client is not None:
+        await asyncio.to_thread(redis_client.delete, f"reply:{cache_key}")
+    else:
+        _reply_cache.pop(cache_key, None)
+
+async def wait_for_reply(cache_key: str) -> Optional[str]:
+    """The reply of the request that claimed the message, or None if it isn't ready in time."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REPLY_WAIT_TIMEOUT
+    while True:
+        content = await get_cached_reply(cache_key)
+        if content != _PENDING_REPLY or loop.time() >= deadline:
+            return content if content != _PENDING_REPLY else None
+        await asyncio.sleep(0.5)
+
+async def cache_reply(cache_key: str, content: str):
+    if redis_client is not None:
+        await asyncio.to_thread(redis_client.set, f"reply:{cache_key}", content, ex=REPLY_CACHE_TTL)
+    else:
+        _reply_cache[cache_key] = content
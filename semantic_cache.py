@@ -0,0 +1,112 @@
+import os
+import re
+import time
+import threading
+import functools
+from collections import OrderedDict
+import numpy as np
+from cachetools import LRUCache
+from embedder import get_embedder
+
+class SemanticCache:
+    """
+    In-memory cache of search results keyed by normalized query embedding.
+    A lookup hits when a stored query has cosine similarity >= threshold.
+    """
+
+    def __init__(self, threshold: float = 0.92, maxsize: int = 512, ttl: float = 300):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # entry id -> (vector, expires_at, value)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, (_, expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, vector: np.ndarray):
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            if not self._entries:
+                return None
+
+            keys = list(self._entries)
+            matrix = np.stack([self._entries[key][0] for key in keys])
+            scores = matrix @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+
+            # Mark as most recently used
+            self._entries.move_to_end(keys[best])
+            return self._entries[keys[best]][2]
+
+    def put(self, vector: np.ndarray, value):
+        with self._lock:
+            self._entries[self._next_id] = (vector, time.monotonic() + self.ttl, value)
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+def _embed_query(query: str) -> np.ndarray:
+    vector = np.asarray(get_embedder()([query])[0], dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Off by default: the stores embed queries themselves, so until they accept
+# query_embeddings every cache miss costs a second embedding
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+
+# Numbers with an optional magnitude, e.g. "2", "1.5m", "500 k", "3 million"
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?(?:\s*(?:k|m)(?:illion)?\b)?")
+
+def _query_numbers(query: str) -> tuple:
+    """Numeric tokens of a query, normalized so "1 m" and "1m" compare equal."""
+    return tuple(match.replace(" ", "") for match in _NUMBER_RE.findall(query.lower()))
+
+def semantic_cache(threshold: float = 0.92, maxsize: int = 512, ttl: float = 300, key_terms=None):
+    """
+    Decorator for `search(query, ...)` functions. Paraphrased queries reuse
+    the results of a recent search instead of hitting the vector store again.
+    Calls with different extra arguments (e.g. n_results) are cached separately.
+
+    Embeddings barely separate queries that differ only in a number or an area
+    ("2 bedroom ..." vs "3 bedroom ..."), so those are matched exactly: the
+    query's numbers, and whatever `key_terms(query)` returns, are part of the key.
+    Returns the function unchanged unless SEMANTIC_CACHE_ENABLED is set.
+    """
+    def decorator(search_fn):
+        if not SEMANTIC_CACHE_ENABLED:
+            return search_fn
+
+        # One SemanticCache per key; the number of distinct keys is unbounded, so keep the recent ones
+        caches = LRUCache(maxsize=256)
+        caches_lock = threading.Lock()
+
+        @functools.wraps(search_fn)
+        def wrapper(query: str, *args, **kwargs):
+            exact_terms = (_query_numbers(query), tuple(key_terms(query)) if key_terms else ())
+            cache_key = (args, tuple(sorted(kwargs.items())), exact_terms)
+            with caches_lock:
+                cache = caches.get(cache_key)
+                if cache is None:
+                    cache = caches[cache_key] = SemanticCache(threshold, maxsize, ttl)
+
+            vector = _embed_query(query)
+            cached = cache.get(vector)
+            if cached is not None:
+                return cached
+
+            # On a miss the store embeds the query again (its search takes text, not
+            # vectors), so a miss costs two embeddings. Once the store modules accept
+            # query_embeddings, pass `vector` through instead.
+            results = search_fn(query, *args, **kwargs)
+            cache.put(vector, results)
+            return results
+
+        return wrapper
+
+    return decorator
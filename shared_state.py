@@ -0,0 +1,14 @@
+import os
+import redis
+from celery import Celery
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# State shared by every web and Celery worker process. Kept apart from siraa_agent
+# so the web processes can reach it without loading the LLM, vector stores and model.
+redis_client = redis.Redis.from_url(os.environ["REDIS_URL"]) if os.getenv("REDIS_URL") else None
+
+# Celery app; run workers with `celery -A tasks worker`
+celery_app = Celery("siraa", broker=os.getenv("REDIS_URL"))
@@ -1,13 +1,23 @@
 import os
 import re
+import csv
 import json
+import time
+import functools
+import threading
+import numpy as np
 from dotenv import load_dotenv
-from typing import Dict
+from typing import Dict, Optional
 from llama_index.llms.google_genai import GoogleGenAI
 from llama_index.core.agent import ReActAgent
 from llama_index.core.tools.function_tool import FunctionTool
 from llama_index.core.tools import QueryEngineTool
 from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.llms import ChatMessage
+from cachetools import TTLCache
+from shared_state import redis_client
+# Imported before the vector stores so torch is configured before any model loads
+from semantic_cache import semantic_cache
 from build_vector_store import PropertyVectorStore
 from build_faq_vector_store import FAQVectorStore
 
@@ -32,6 +42,42 @@ faq_store = FAQVectorStore(
     persist_directory="faq_vector_store"
 )
 
+# Area names from the catalogue (e.g. "dubai marina", "ras al khor")
+with open("property_details_locations_rows.csv", newline="") as f:
+    _AREA_NAMES = {
+        part.strip().lower()
+        for row in csv.DictReader(f)
+        for part in (row["location"] or "").split(",")
+        if part.strip()
+    }
+_AREA_RE = re.compile(
+    r"(?<!\w)(?:" + "|".join(map(re.escape, sorted(_AREA_NAMES, key=len, reverse=True))) + r")(?!\w)"
+)
+
+def _query_areas(query: str) -> list:
+    """Areas named in a query; searches for different areas never share cached results."""
+    return sorted(set(_AREA_RE.findall(query.lower())))
+
+# Serve paraphrased queries from a semantic cache instead of re-running the vector search
+# (enabled with SEMANTIC_CACHE_ENABLED)
+property_store.search = semantic_cache(key_terms=_query_areas)(property_store.search)
+faq_store.search = semantic_cache()(faq_store.search)
+
+# Lowercased property name -> metadata, for exact-name lookups without a vector search.
+# Only metadata is fetched: documents and embeddings are never needed here.
+_PROP_INDEX = {
+    meta["property_name"].strip().lower(): meta
+    for meta in property_store.collection.get(include=["metadatas"])["metadatas"]
+    if meta and meta.get("property_name")
+}
+
+# Match formats like "1 million", "1m", "1.5m", "500k", "1000000"
+_BUDGET_PATTERNS = [
+    (re.compile(r"(\d+(\.\d+)?)\s*m(illion)?"), 1_000_000),
+    (re.compile(r"(\d+(\.\d+)?)\s*k"), 1_000),
+    (re.compile(r"\b(\d{6,})\b"), 1)  # raw numbers like 750000
+]
+
 def extract_budget(query: str) -> int | None:
     """
     Extract numeric budget from user query.
@@ -39,21 +85,27 @@ def extract_budget(query: str) -> int | None:
     """
     query = query.lower().replace(",", "")
     
-    # Match formats like "1 million", "1m", "1.5m", "500k", "1000000"
-    patterns = [
-        (r"(\d+(\.\d+)?)\s*m(illion)?", 1_000_000),
-        (r"(\d+(\.\d+)?)\s*k", 1_000),
-        (r"\b(\d{6,})\b", 1)  # raw numbers like 750000
-    ]
-    
-    for pattern, multiplier in patterns:
-        match = re.search(pattern, query)
+    for pattern, multiplier in _BUDGET_PATTERNS:
+        match = pattern.search(query)
         if match:
             number = float(match.group(1))
             return int(number * multiplier)
     
     return None
 
+def _price_numeric(metadata: Dict) -> float:
+    """
+    Numeric price of a property, or NaN if it can't be parsed.
+    Uses the precomputed `price_numeric` metadata field when the store provides it.
+    """
+    if "price_numeric" in metadata:
+        try:
+            return float(metadata["price_numeric"])
+        except (ValueError, TypeError):
+            return float("nan")
+    digits = ''.join(filter(str.isdigit, str(metadata.get("price", "0"))))
+    return float(digits) if digits else float("nan")
+
 def search_properties(query: str) -> str:
     """Search for properties based on the query."""
     try:
@@ -64,18 +116,10 @@ def search_properties(query: str) -> str:
             return "No properties found matching your criteria."
         
         if budget:
-            filtered_results = []
-            for result in initial_results:
-                try:
-                    price_str = result.get("metadata", {}).get("price", "0")
-                    price_numeric = float(''.join(filter(str.isdigit, str(price_str))))
-                    if price_numeric <= budget:
-                        filtered_results.append(result)
-                except (ValueError, TypeError):
-                    # Still include unparseable ones
-                    filtered_results.append(result)
-            
-            results = filtered_results[:5]
+            prices = np.array([_price_numeric(result.get("metadata", {})) for result in initial_results])
+            # Still include unparseable (NaN) ones
+            mask = (prices <= budget) | np.isnan(prices)
+            results = [initial_results[i] for i in np.flatnonzero(mask)[:5]]
             if not results:
                 return f"I couldn't find properties within your budget of {budget:,} AED. Here are some slightly higher-priced options:\n\n" + format_properties(initial_results[:3], query)
         else:
@@ -162,46 +206,13 @@ faq_tool = FunctionTool.from_defaults(
     description="Answer general questions about Siraa or the buying process."
 )
 
-def find_brochure_by_property_name(property_name: str):
-    results = property_store.search("", n_results=1000)
-    for result in results:
-        meta = result.get("metadata", {})
-        if meta.get("property_name", "").strip().lower() == property_name.strip().lower():
-            return meta.get("brochure", "No brochure found.")
-    return "Brochure not found."
-
-def find_floor_plan_by_property_name(property_name: str):
-    results = property_store.search("", n_results=1000)
-    for result in results:
-        meta = result.get("metadata", {})
-        if meta.get("property_name", "").strip().lower() == property_name.strip().lower():
-            return meta.get("floor_plans", "No floor plan found.")
-    return "Floor plan not found."
-
-brochure_tool = FunctionTool.from_defaults(
-    fn=find_brochure_by_property_name,
-    name="FindBrochure",
-    description="Get brochure PDF URL for a specific property."
-)
-
-floorplan_tool = FunctionTool.from_defaults(
-    fn=find_floor_plan_by_property_name,
-    name="FindFloorPlan",
-    description="Get property floor plan PDF URL for a specific property."
-)
-
-# Add these functions after the existing tool functions
-
 def find_property_image_by_name(property_name: str):
     """Find property image URL by property name."""
     try:
-        results = property_store.search("", n_results=1000)
-        for result in results:
-            meta = result.get("metadata", {})
-            if meta.get("property_name", "").strip().lower() == property_name.strip().lower():
-                image_url = meta.get("compressed_hero_image_link", "")
-                if image_url and image_url != "Not available":
-                    return image_url
+        meta = _PROP_INDEX.get(property_name.strip().lower())
+        image_url = meta.get("compressed_hero_image_link", "") if meta else ""
+        if image_url and image_url != "Not available":
+            return image_url
         return "Image not found for this property."
     except Exception as e:
         print(f"Image search error: {e}")
@@ -210,13 +221,10 @@ def find_property_image_by_name(property_name: str):
 def find_property_brochure_by_name(property_name: str):
     """Find property brochure URL by property name."""
     try:
-        results = property_store.search("", n_results=1000)
-        for result in results:
-            meta = result.get("metadata", {})
-            if meta.get("property_name", "").strip().lower() == property_name.strip().lower():
-                brochure_url = meta.get("brochure", "")
-                if brochure_url and brochure_url != "Not available":
-                    return brochure_url
+        meta = _PROP_INDEX.get(property_name.strip().lower())
+        brochure_url = meta.get("brochure", "") if meta else ""
+        if brochure_url and brochure_url != "Not available":
+            return brochure_url
         return "Brochure not found for this property."
     except Exception as e:
         print(f"Brochure search error: {e}")
@@ -225,32 +233,19 @@ def find_property_brochure_by_name(property_name: str):
 def find_property_floor_plan_by_name(property_name: str):
     """Find property floor plan URL by property name."""
     try:
-        results = property_store.search("", n_results=1000)
-        for result in results:
-            meta = result.get("metadata", {})
-            if meta.get("property_name", "").strip().lower() == property_name.strip().lower():
-                floor_plan_url = meta.get("floor_plans", "")
-                if floor_plan_url and floor_plan_url != "Not available":
-                    return floor_plan_url
+        meta = _PROP_INDEX.get(property_name.strip().lower())
+        floor_plan_url = meta.get("floor_plans", "") if meta else ""
+        if floor_plan_url and floor_plan_url != "Not available":
+            return floor_plan_url
         return "Floor plan not found for this property."
     except Exception as e:
         print(f"Floor plan search error: {e}")
         return "Unable to find floor plan at the moment."
 
+@functools.lru_cache(maxsize=1)
 def get_all_property_names():
-    """Get all available property names for reference."""
-    try:
-        results = property_store.search("", n_results=1000)
-        property_names = []
-        for result in results:
-            meta = result.get("metadata", {})
-            property_name = meta.get("property_name", "")
-            if property_name:
-                property_names.append(property_name)
-        return property_names
-    except Exception as e:
-        print(f"Property names search error: {e}")
-        return []
+    """Get all available property names for reference (static between store builds)."""
+    return tuple(meta["property_name"] for meta in _PROP_INDEX.values())
 
 # Create media tool wrappers
 image_tool = FunctionTool.from_defaults(
@@ -281,8 +276,168 @@ RULES:
 - For all other general questions, use the `FAQSearch` tool.
 """
 
-# Global: hold reference to memory/agent
-session_memory_map = {}
+# Deterministic routing for media requests naming one property, mirroring the
+# SYSTEM_PROMPT rules without a ReAct round-trip to the LLM. Searches and FAQs
+# depend on preferences and history, so they are always left to the agent.
+_MEDIA_ROUTES = [
+    (("brochure",), find_property_brochure_by_name),
+    (("floor plan", "floorplan", "floor-plan"), find_property_floor_plan_by_name),
+    (("image", "photo", "picture"), find_property_image_by_name),
+]
+# Requests that also ask for a search or an FAQ answer ("show me villas. also send me
+# the brochure for Altus") are left to the agent rather than half answered
+_PROPERTY_KEYWORDS = re.compile(r"\b(propert(y|ies)|apartments?|villas?|townhouses?|penthouses?|\d+\s*(bed|br|bedroom)s?)\b")
+_SEARCH_KEYWORDS = re.compile(r"\b(looking for|show me|find|search|recommend|available|under|below|within|budget)\b")
+_FAQ_KEYWORDS = re.compile(
+    r"\b(mortgages?|loans?|financ\w*|process|procedures?|documents?|paperwork|fees?|visas?|residency"
+    r"|tax(es)?|legal|laws?|regulations?|siraa|company|explain|tell me about|know about|learn about)\b"
+)
+# Known property names as whole words, longest first so e.g. "sobha one" wins over "sobha".
+# Lookarounds rather than \b, since names may start or end with punctuation.
+_PROP_NAMES = "|".join(map(re.escape, sorted(_PROP_INDEX, key=len, reverse=True)))
+_PROP_NAME_RE = re.compile(r"(?<!\w)(?:" + _PROP_NAMES + r")(?!\w)") if _PROP_INDEX else None
+# A media request names its property last ("brochure for Sobha One?"). Several catalogue
+# names are common words (Central, Amber, Galaxy), so a name followed by more words
+# ("photo of the central courtyard at altus") isn't taken as the property asked for.
+_TRAILING_PROP_NAME_RE = re.compile(r"(?<!\w)(" + _PROP_NAMES + r")[\s.,!?]*$") if _PROP_INDEX else None
+
+def _find_property_name(message_lower: str) -> Optional[str]:
+    """
+    The property a media request asks for: the only known name in the message,
+    ending it. None when no name, several names, or a name mid-sentence match.
+    """
+    if _PROP_NAME_RE is None or len(set(_PROP_NAME_RE.findall(message_lower))) != 1:
+        return None
+    match = _TRAILING_PROP_NAME_RE.search(message_lower)
+    return match.group(1) if match else None
+
+def route_message(message: str) -> Optional[str]:
+    """
+    Answer a media request by calling its tool directly when the intent is unambiguous.
+    Returns None when the agent should handle the message instead.
+    """
+    message_lower = message.lower()
+
+    media_tools = [tool_fn for keywords, tool_fn in _MEDIA_ROUTES if any(keyword in message_lower for keyword in keywords)]
+    if len(media_tools) != 1:
+        return None
+    property_name = _find_property_name(message_lower)
+    if not property_name:
+        return None
+    rest = _TRAILING_PROP_NAME_RE.sub("", message_lower)
+    if (_PROPERTY_KEYWORDS.search(rest) and _SEARCH_KEYWORDS.search(rest)) or _FAQ_KEYWORDS.search(rest):
+        return None
+    return media_tools[0](property_name)
+
+def respond(agent: ReActAgent, message: str, agent_prompt: Optional[str] = None) -> str:
+    """
+    Reply to a user message, skipping the agent when it can be routed directly.
+    `agent_prompt` (defaults to the message) is what the agent sees if it runs.
+    """
+    routed = route_message(message)
+    if routed is None:
+        return agent.chat(agent_prompt or message).response
+
+    # Keep routed turns in the conversation so follow-ups have context
+    agent.memory.put(ChatMessage(role="user", content=message))
+    agent.memory.put(ChatMessage(role="assistant", content=routed))
+    return routed
+
+# Session state (preferences + chat history) is persisted so it survives restarts.
+# With REDIS_URL set it lives in Redis, shared by all workers and expiring after
+# SESSION_TTL seconds idle; otherwise it is written to SESSIONS_DIR after every turn.
+SESSIONS_DIR = "sessions"
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+
+def _session_path(session_id: str) -> str:
+    return os.path.join(SESSIONS_DIR, f"{session_id}.json")
+
+def _session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+# Sorted set of session id -> time of its last saved turn, for finding recent sessions
+_RECENT_SESSIONS_KEY = "sessions:recent"
+
+def _save_session(session_id: str, session: Dict):
+    """Persist a session's preferences and chat history."""
+    try:
+        state = json.dumps({
+            "preferences": session.get("preferences", {}),
+            "messages": [
+                {"role": message.role.value, "content": message.content}
+                for message in session["memory"].get_all()
+            ]
+        })
+        if redis_client is not None:
+            pipe = redis_client.pipeline()
+            pipe.set(_session_key(session_id), state, ex=SESSION_TTL)
+            pipe.zadd(_RECENT_SESSIONS_KEY, {session_id: time.time()})
+            pipe.execute()
+            return
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        # Write a temp file and swap it in, so a crash mid-write never leaves a truncated session
+        tmp_path = _session_path(session_id) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(state)
+        os.replace(tmp_path, _session_path(session_id))
+    except Exception as e:
+        print(f"[SESSION SAVE ERROR] {session_id}: {e}")
+
+def _read_session_state(session_id: str):
+    """Persisted state of a session, or None if there is none."""
+    try:
+        if redis_client is not None:
+            state = redis_client.get(_session_key(session_id))
+        elif os.path.exists(_session_path(session_id)):
+            with open(_session_path(session_id), "r", encoding="utf-8") as f:
+                state = f.read()
+        else:
+            state = None
+        return json.loads(state) if state is not None else None
+    except Exception as e:
+        print(f"[SESSION LOAD ERROR] {session_id}: {e}")
+        return None
+
+def _apply_session_state(session: Dict, state: Dict):
+    session["preferences"] = dict(state.get("preferences", {}))
+    session["memory"].set([ChatMessage(role=m["role"], content=m["content"]) for m in state.get("messages", [])])
+
+def _load_session(session_id: str):
+    """Rebuild a persisted session, or return None if there is none."""
+    state = _read_session_state(session_id)
+    if state is None:
+        return None
+
+    create_agent_for_user(session_id)
+    session = session_memory_map.get(session_id)
+    _apply_session_state(session, state)
+    return session
+
+def _spill_session(session_id: str, session: Dict):
+    # Redis-backed sessions are written through after every turn, and the local copy
+    # may be stale (another worker handled a later turn, or the session was reset),
+    # so only disk-backed sessions are saved on eviction
+    if redis_client is None:
+        _save_session(session_id, session)
+
+class _SpillingSessionCache(TTLCache):
+    """TTL + LRU bounded cache of warm sessions that persists evicted ones."""
+
+    def popitem(self):
+        session_id, session = super().popitem()
+        _spill_session(session_id, session)
+        return session_id, session
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for session_id, session in expired or ():
+            _spill_session(session_id, session)
+        return expired
+
+# Global: hold reference to memory/agent for active sessions in this process.
+# The cache isn't thread-safe and is used from webhook worker threads, so guard it.
+session_memory_map = _SpillingSessionCache(maxsize=int(os.getenv("MAX_SESSIONS", "1024")), ttl=3600)
+_session_map_lock = threading.RLock()
 
 def create_agent_for_user(session_id: str) -> ReActAgent:
     memory = ChatMemoryBuffer.from_defaults()
@@ -295,56 +450,162 @@ def create_agent_for_user(session_id: str) -> ReActAgent:
         verbose=True
     )
 
-    session_memory_map[session_id] = {
-        "agent": agent,
-        "preferences": {},
-        "memory": memory
-    }
+    with _session_map_lock:
+        session_memory_map[session_id] = {
+            "agent": agent,
+            "preferences": {},
+            "memory": memory
+        }
 
     return agent
 
-def extract_preferences_with_llm(message: str, current_preferences: Dict) -> Dict:
-    prompt = f"""Analyze this message and extract real estate preferences.
+def extract_preferences_and_context_with_llm(message: str, current_preferences: Dict) -> Dict:
+    """
+    Extract new real estate preferences and classify the message in one LLM call.
+    Returns {"preferences": {...}, "context": "property" | "general"}.
+    """
+    prompt = f"""Analyze this message, extract real estate preferences and classify it.
 
 Current preferences: {current_preferences}
 Message: {message}
 
-Return a JSON with these fields ONLY if they are mentioned:
+Return only a JSON object of this form:
 {{
-  "location": "e.g. Dubai Marina",
-  "property_type": "apartment/villa/etc.",
-  "bedrooms": "number or range",
-  "budget": "number or range",
-  "amenities": ["list", "of", "amenities"]
+  "preferences": {{
+    "location": "e.g. Dubai Marina",
+    "property_type": "apartment/villa/etc.",
+    "bedrooms": "number or range",
+    "budget": "number or range",
+    "amenities": ["list", "of", "amenities"]
+  }},
+  "context": "property or general"
 }}
-If no new info, return {{}}.
+Include a preference field ONLY if it is mentioned; if no new info, "preferences" is {{}}.
+"context" is "property" if the message is about finding/recommending properties,
+"general" if it is about the company or buying process.
 """
     try:
         response = llm.complete(prompt)
-        return json.loads(response.text)
+        # Gemini sometimes wraps JSON answers in a ```json fence
+        text = response.text.strip().removeprefix("```json").strip("`").strip()
+        result = json.loads(text)
     except Exception as e:
         print(f"[PREFERENCE EXTRACTION ERROR] {e}")
-        return {}
+        return {"preferences": {}, "context": "property"}
 
-def determine_query_context(message: str) -> str:
-    prompt = f"""Classify this message:
-- "property" if it's about finding/recommending properties
-- "general" if it's about the company or buying process
+    # Valid JSON isn't necessarily the requested shape (e.g. a list, or a string for preferences)
+    if not isinstance(result, dict) or not isinstance(result.get("preferences") or {}, dict):
+        print(f"[PREFERENCE EXTRACTION ERROR] Unexpected response: {text}")
+        return {"preferences": {}, "context": "property"}
 
-Message: {message}
-Answer with only: property or general."""
-    try:
-        response = llm.complete(prompt)
-        return response.text.strip().lower()
-    except:
-        return "property"
+    context = str(result.get("context", "property")).strip().lower()
+    return {
+        "preferences": result.get("preferences") or {},
+        "context": context if context in ("property", "general") else "property"
+    }
 
 def get_session_data(session_id: str):
-    return session_memory_map.get(session_id)
+    with _session_map_lock:
+        # Spill expired sessions first so a reload sees their latest state
+        session_memory_map.expire()
+        session = session_memory_map.get(session_id)
+        if session is None:
+            return _load_session(session_id)
+        # TTLCache counts its TTL from insertion; re-inserting on access makes
+        # sessions expire after an hour idle rather than an hour after creation
+        session_memory_map[session_id] = session
+
+    # With several workers another process may have handled the last turn,
+    # so a warm session only keeps its agent and takes its state from Redis
+    if redis_client is not None:
+        state = _read_session_state(session_id)
+        if state is None:
+            # Idle past SESSION_TTL (or reset): don't resurrect the old memory
+            with _session_map_lock:
+                session_memory_map.pop(session_id, None)
+            return None
+        _apply_session_state(session, state)
+    return session
+
+def get_or_create_agent(session_id: str) -> ReActAgent:
+    """Return the session's agent, rehydrating or creating the session as needed."""
+    session = get_session_data(session_id)
+    if session:
+        return session["agent"]
+
+    agent = create_agent_for_user(session_id)
+    # Create the Redis key right away, so a concurrent lookup before the first
+    # turn is saved doesn't mistake the new session for an expired one
+    save_session(session_id)
+    return agent
+
+def save_session(session_id: str):
+    """
+    Write the session's current state through to Redis or disk after a turn,
+    so other workers, restarts and crashes see it.
+    """
+    with _session_map_lock:
+        session = session_memory_map.get(session_id)
+    if session is not None:
+        _save_session(session_id, session)
+
+def recent_session_ids(limit: int) -> list:
+    """IDs of the most recently active persisted sessions, newest first."""
+    if redis_client is not None:
+        # Drop sessions idle past SESSION_TTL (their state has expired), then take the newest
+        pipe = redis_client.pipeline()
+        pipe.zremrangebyscore(_RECENT_SESSIONS_KEY, "-inf", time.time() - SESSION_TTL)
+        pipe.zrevrange(_RECENT_SESSIONS_KEY, 0, limit - 1)
+        _, session_ids = pipe.execute()
+        return [session_id.decode() for session_id in session_ids]
+
+    if not os.path.isdir(SESSIONS_DIR):
+        return []
+    paths = [os.path.join(SESSIONS_DIR, name) for name in os.listdir(SESSIONS_DIR) if name.endswith(".json")]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return [os.path.basename(path).removesuffix(".json") for path in paths[:limit]]
+
+# Number of recently active sessions to load into memory when a process starts
+PREWARM_SESSIONS = int(os.getenv("PREWARM_SESSIONS", "50"))
+
+def prewarm_sessions(limit: int = PREWARM_SESSIONS):
+    """Rebuild agents for recently active users so their next message skips agent creation."""
+    try:
+        session_ids = recent_session_ids(limit)
+    except Exception as e:
+        print(f"[PREWARM ERROR] Listing sessions failed: {e}")
+        return
+    for session_id in session_ids:
+        try:
+            get_session_data(session_id)
+        except Exception as e:
+            print(f"[PREWARM ERROR] {session_id}: {e}")
+    print(f"Prewarmed {len(session_ids)} sessions")
+
+def spill_sessions():
+    """Save every warm disk-backed session; call on shutdown so none are lost."""
+    with _session_map_lock:
+        session_memory_map.expire()
+        for session_id in list(session_memory_map.keys()):
+            session = session_memory_map.get(session_id)
+            if session is not None:
+                _spill_session(session_id, session)
+
+def cleanup_sessions():
+    """Evict expired sessions from this process; meant to run periodically."""
+    with _session_map_lock:
+        session_memory_map.expire()
 
 def reset_session(session_id: str):
-    if session_id in session_memory_map:
-        del session_memory_map[session_id]
+    with _session_map_lock:
+        session_memory_map.pop(session_id, None)
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.delete(_session_key(session_id))
+        pipe.zrem(_RECENT_SESSIONS_KEY, session_id)
+        pipe.execute()
+    elif os.path.exists(_session_path(session_id)):
+        os.remove(_session_path(session_id))
 
 def main():
     """
@@ -355,8 +616,9 @@ def main():
     print("-" * 50)
 
     session_id = "test_user"
-    agent = create_agent_for_user(session_id)
-    session = get_session_data(session_id)
+    agent = get_or_create_agent(session_id)
+    with _session_map_lock:
+        session = session_memory_map[session_id]
 
     while True:
         try:
@@ -365,20 +627,19 @@ def main():
                 print("Siraa: 👋 Goodbye!")
                 break
 
-            # Extract preferences from the message
-            new_prefs = extract_preferences_with_llm(user_input, session["preferences"])
-            session["preferences"].update(new_prefs)
-
-            # Determine context (property vs general)
-            context = determine_query_context(user_input)
+            # Extract preferences and determine context (property vs general) in one call
+            result = extract_preferences_and_context_with_llm(user_input, session["preferences"])
+            session["preferences"].update(result["preferences"])
+            context = result["context"]
             if context == "property":
                 user_prompt = f"Current preferences: {session['preferences']}\n\nUser message: {user_input}"
             else:
                 user_prompt = user_input
 
-            # Run agent using chat method
-            response = agent.chat(user_prompt)
-            print(f"Siraa: {response.response}")
+            # Route directly to a tool when possible, otherwise run the agent
+            response = respond(agent, user_input, user_prompt)
+            save_session(session_id)
+            print(f"Siraa: {response}")
 
         except KeyboardInterrupt:
             print("\nSiraa: 👋 Goodbye!")
@@ -387,6 +648,8 @@ def main():
             print(f"❌ Error: {e}")
             continue
 
+    spill_sessions()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,94 @@
+import os
+import logging
+import threading
+from celery.signals import worker_process_init
+from dotenv import load_dotenv
+from redis.exceptions import LockError
+
+from shared_state import celery_app, redis_client
+from siraa_agent import PREWARM_SESSIONS, get_or_create_agent, prewarm_sessions, respond, save_session
+from twilio_client import TWILIO_FROM, get_twilio_client
+from messaging import ERROR_MESSAGE, extract_url_from_text, split_message
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Celery app (defined in shared_state, so the webhook can queue tasks without
+# importing this module); run workers with `celery -A tasks worker`
+app = celery_app
+
+# Longest a turn may hold its session's lock
+SESSION_LOCK_TIMEOUT = int(os.getenv("SESSION_LOCK_TIMEOUT", "300"))
+# A turn whose session is busy waits briefly, then is requeued so it doesn't tie up
+# a worker process; after LOCK_MAX_WAITS requeues the user is told to try again
+LOCK_WAIT_SECONDS = 2
+LOCK_RETRY_DELAY = 5
+LOCK_MAX_WAITS = 60
+
+@worker_process_init.connect
+def _start_prewarm(**kwargs):
+    # Agents run in the worker processes, so warm sessions there. Done on a thread
+    # because worker_process_init handlers must return quickly.
+    if PREWARM_SESSIONS > 0:
+        threading.Thread(target=prewarm_sessions, name="prewarm-sessions", daemon=True).start()
+
+@app.task(bind=True, max_retries=3)
+def run_agent(self, session_id: str, from_number: str, message_body: str, lock_waits: int = 0):
+    """
+    Run the agent for one incoming WhatsApp message and send the reply
+    through the Twilio REST API. `session_id` comes from the webhook, which
+    owns the session id format.
+    """
+    # One turn per session at a time across all worker processes, so concurrent
+    # turns can't save over each other's history. The lock isn't FIFO, so it
+    # doesn't order turns that arrive together.
+    lock = redis_client.lock(f"lock:{session_id}", timeout=SESSION_LOCK_TIMEOUT)
+    if not lock.acquire(blocking_timeout=LOCK_WAIT_SECONDS):
+        if lock_waits >= LOCK_MAX_WAITS:
+            logger.error("Session %s stayed busy; dropping message from %s", session_id, from_number)
+            get_twilio_client().messages.create(from_=TWILIO_FROM, to=f"whatsapp:{from_number}", body=ERROR_MESSAGE)
+            return
+        # Lock waits have their own budget, separate from agent failures
+        raise self.retry(
+            kwargs={"lock_waits": lock_waits + 1},
+            countdown=LOCK_RETRY_DELAY,
+            max_retries=self.max_retries + LOCK_MAX_WAITS,
+        )
+    try:
+        _run_turn(self, session_id, from_number, message_body, lock_waits)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # Held past SESSION_LOCK_TIMEOUT; the lock already expired
+            pass
+
+def _run_turn(task, session_id: str, from_number: str, message_body: str, lock_waits: int):
+    """Answer one message; called with the session's lock held."""
+    twilio_client = get_twilio_client()
+    to = f"whatsapp:{from_number}"
+    try:
+        agent = get_or_create_agent(session_id)
+        response_text = respond(agent, message_body).strip()
+        save_session(session_id)
+    except Exception as e:
+        logger.exception("Agent run failed for %s: %s", from_number, e)
+        # Retries spent waiting for the lock don't count against agent failures
+        failures = task.request.retries - lock_waits
+        if failures >= task.max_retries:
+            # Out of retries: tell the user instead of leaving the message unanswered
+            twilio_client.messages.create(from_=TWILIO_FROM, to=to, body=ERROR_MESSAGE)
+            raise
+        raise task.retry(exc=e, countdown=2 ** failures, max_retries=task.max_retries + lock_waits)
+
+    media_url = extract_url_from_text(response_text)
+    if media_url:
+        # Send a message with only the media, no body text.
+        twilio_client.messages.create(from_=TWILIO_FROM, to=to, media_url=[media_url])
+        logger.info("Response: Media URL - %s", media_url)
+    else:
+        for chunk in split_message(response_text):
+            twilio_client.messages.create(from_=TWILIO_FROM, to=to, body=chunk)
+        logger.info("Response: Text - %s", response_text)
@@ -0,0 +1,24 @@
+import os
+import functools
+from requests.adapters import HTTPAdapter
+from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Sender for outbound WhatsApp messages
+TWILIO_FROM = "whatsapp:" + os.getenv("TWILIO_PHONE_NUMBER", "").replace("whatsapp:", "")
+
+@functools.lru_cache(maxsize=1)
+def get_twilio_client() -> Client:
+    """
+    Return the process-wide Twilio REST client, created on first use.
+    Its HTTP session keeps connections to the Twilio API alive, so sending
+    several chunks of a reply reuses one TLS connection.
+    """
+    http_client = TwilioHttpClient(pool_connections=True)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+    http_client.session.mount("https://", adapter)
+    return Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"], http_client=http_client)
@@ -1,6 +1,12 @@
 import os
 import json
-import re
+import logging
+import logging.handlers
+import queue
+import functools
+import weakref
+from collections import defaultdict
+from xml.sax.saxutils import escape
 from typing import Dict, List, Optional
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse, Response
@@ -9,145 +15,296 @@ import requests
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 import asyncio
+from uuid import uuid4
 from dotenv import load_dotenv
 
-# Import our Siraa agent
-from siraa_agent import create_agent_for_user, get_session_data, reset_session, get_all_property_names
+from twilio_client import TWILIO_FROM, get_twilio_client
+from messaging import ERROR_MESSAGE, extract_url_from_text, split_message
+from reply_cache import reply_cache_key, claim_reply, release_reply, wait_for_reply, cache_reply
 
 # Load environment variables
 load_dotenv()
 
+# With a Redis broker configured, agent runs are offloaded to Celery workers (see tasks.py).
+# The web process then never runs the agent, so it doesn't load it (or its models) at all.
+TASK_QUEUE_ENABLED = bool(os.getenv("REDIS_URL"))
+if TASK_QUEUE_ENABLED:
+    from shared_state import celery_app
+else:
+    # Import our Siraa agent
+    from siraa_agent import PREWARM_SESSIONS, get_or_create_agent, prewarm_sessions, save_session, cleanup_sessions, spill_sessions, reset_session, get_all_property_names, respond
+
 # Initialize FastAPI app
 app = FastAPI(title="Siraa WhatsApp Bot", version="1.0.0")
 
-# Global session management
-session_memory_map = {}
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted, so formatting happens on the listener thread too."""
 
-def extract_url_from_text(text: str) -> Optional[str]:
-    """Finds the first HTTP or HTTPS URL in a string."""
-    # This regex is simple and effective for this use case.
-    match = re.search(r'https?://[^\s]+', text)
-    if match:
-        return match.group(0)
-    return None
+    def prepare(self, record):
+        return record
 
-def split_message(text: str, limit: int = 1600) -> List[str]:
+def _setup_logging() -> logging.handlers.QueueListener:
     """
-    Splits a long message into multiple chunks under the character limit,
-    preferring to split at newlines.
+    Hand log records to a queue; a background listener thread formats and writes
+    them, so a slow stdout never blocks the event loop. Runs once per process:
+    if the module is imported again, the existing listener is reused.
     """
-    if len(text) <= limit:
-        return [text]
-
-    chunks = []
-    current_chunk = ""
-    lines = text.split('\n')
-
-    for line in lines:
-        # If adding the next line (plus a newline character) exceeds the limit
-        if len(current_chunk) + len(line) + 1 > limit:
-            # If the current chunk is not empty, add it to the list
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = line + "\n"
-        else:
-            current_chunk += line + "\n"
-    
-    # Add the last remaining chunk
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    # Final check: if any single line was over the limit, we need to split it by force
-    final_chunks = []
-    for chunk in chunks:
-        if len(chunk) > limit:
-            for i in range(0, len(chunk), limit):
-                final_chunks.append(chunk[i:i+limit])
-        else:
-            final_chunks.append(chunk)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.QueueHandler) and getattr(handler, "listener", None) is not None:
+            return handler.listener
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.listener = listener
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener.start()
+    return listener
+
+_log_listener = _setup_logging()
+logger = logging.getLogger(__name__)
+
+# Sessions are managed by siraa_agent (warm in-process cache backed by Redis or disk)
+SESSION_CLEANUP_INTERVAL = int(os.getenv("SESSION_CLEANUP_INTERVAL", "900"))
+# Per-session locks, so concurrent messages from one user don't build two agents or
+# run the same agent twice at once, while other users' turns run in parallel.
+# Unused locks are dropped automatically.
+_session_locks = weakref.WeakValueDictionary()
+
+def _session_lock(session_id: str) -> asyncio.Lock:
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = _session_locks[session_id] = asyncio.Lock()
+    return lock
+# Caps concurrent LLM calls to stay within API rate limits and bound thread fan-out
+_LLM_SEM = asyncio.Semaphore(int(os.getenv("LLM_CONCURRENCY", "8")))
+
+def _build_error_twiml() -> str:
+    twiml = MessagingResponse()
+    twiml.message(ERROR_MESSAGE)
+    return str(twiml)
+
+# Fixed TwiML documents, built once at import instead of per request.
+# The empty one acknowledges a webhook without replying through TwiML.
+_EMPTY_TWIML = str(MessagingResponse())
+_ERROR_TWIML = _build_error_twiml()
+
+# Twilio gives up on a webhook request after 15s; replies ready later than this
+# are sent through the REST API rather than on a connection it has dropped
+WEBHOOK_REPLY_DEADLINE = 12
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+_background_tasks = set()
 
-    return final_chunks
+def _single_message_twiml(text: str) -> str:
+    """TwiML for a single text message, equivalent to MessagingResponse().message(text)."""
+    return f'<?xml version="1.0" encoding="UTF-8"?><Response><Message>{escape(text)}</Message></Response>'
+
+def _media_message_twiml(media_url: str) -> str:
+    """TwiML for a media-only message, equivalent to MessagingResponse().message().media(url)."""
+    return f'<?xml version="1.0" encoding="UTF-8"?><Response><Message><Media>{escape(media_url)}</Media></Message></Response>'
+
+@functools.lru_cache(maxsize=4)
+def _property_match_index(available_properties: tuple):
+    """
+    Precompute lowercase names and a word -> property positions index.
+    Cached per property list, so it is rebuilt only when the list changes.
+    """
+    lowered = [prop.lower() for prop in available_properties]
+    exact = {}
+    word_index = defaultdict(set)
+    for position, prop_lower in enumerate(lowered):
+        exact.setdefault(prop_lower, available_properties[position])
+        for word in prop_lower.split():
+            word_index[word].add(position)
+    return lowered, exact, word_index
 
 def find_best_property_match(property_name: str, available_properties: List[str]) -> Optional[str]:
     """Find the best matching property name."""
+    available_properties = tuple(available_properties)
+    lowered, exact, word_index = _property_match_index(available_properties)
     property_name_lower = property_name.lower().strip()
     
     # First try exact match
-    for prop in available_properties:
-        if prop.lower() == property_name_lower:
-            return prop
+    if property_name_lower in exact:
+        return exact[property_name_lower]
     
     # Then try contains match
-    for prop in available_properties:
-        if property_name_lower in prop.lower() or prop.lower() in property_name_lower:
-            return prop
+    for position, prop_lower in enumerate(lowered):
+        if property_name_lower in prop_lower or prop_lower in property_name_lower:
+            return available_properties[position]
     
-    # Then try word-based matching
-    property_words = set(property_name_lower.split())
-    for prop in available_properties:
-        prop_words = set(prop.lower().split())
-        if property_words & prop_words:  # If there's any word overlap
-            return prop
+    # Then try word-based matching: earliest property sharing any word
+    positions = set().union(*(word_index.get(word, ()) for word in property_name_lower.split()))
+    if positions:
+        return available_properties[min(positions)]
     
     return None
 
-def get_session_id(phone_number: str) -> str:
-    """Get or create session ID for a phone number."""
-    return f"whatsapp_{phone_number}"
+async def _send_chunks(from_number: str, chunks: List[str]):
+    """Send reply chunks in order as separate WhatsApp messages."""
+    try:
+        twilio_client = get_twilio_client()
+        for chunk in chunks:
+            await asyncio.to_thread(
+                twilio_client.messages.create, from_=TWILIO_FROM, to=f"whatsapp:{from_number}", body=chunk
+            )
+    except Exception as e:
+        logger.exception("Sending reply chunks to %s failed: %s", from_number, e)
+
+async def _send_media(from_number: str, media_url: str):
+    """Send a media-only WhatsApp message."""
+    try:
+        twilio_client = get_twilio_client()
+        await asyncio.to_thread(
+            twilio_client.messages.create, from_=TWILIO_FROM, to=f"whatsapp:{from_number}", media_url=[media_url]
+        )
+    except Exception as e:
+        logger.exception("Sending media to %s failed: %s", from_number, e)
+
+def _send_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _session_cleanup_loop():
+    """Periodically evict idle sessions from this worker."""
+    while True:
+        await asyncio.sleep(SESSION_CLEANUP_INTERVAL)
+        try:
+            await asyncio.to_thread(cleanup_sessions)
+        except Exception as e:
+            logger.exception("Session cleanup failed: %s", e)
+
+async def _prewarm_sessions():
+    # Prewarming builds agents, so it takes one LLM slot like a live turn would
+    async with _LLM_SEM:
+        await asyncio.to_thread(prewarm_sessions, PREWARM_SESSIONS)
+
+@app.on_event("shutdown")
+async def _spill_sessions():
+    # Agents (and their sessions) only live in this process without the task queue
+    if TASK_QUEUE_ENABLED:
+        return
+    try:
+        await asyncio.to_thread(spill_sessions)
+    except Exception as e:
+        logger.exception("Saving sessions on shutdown failed: %s", e)
+
+@app.on_event("shutdown")
+async def _stop_log_listener():
+    _log_listener.stop()
+
+@app.on_event("startup")
+async def _start_background_tasks():
+    # Build the Twilio client (and its connection pool) now rather than on the first send
+    if os.getenv("TWILIO_ACCOUNT_SID") and os.getenv("TWILIO_AUTH_TOKEN"):
+        await asyncio.to_thread(get_twilio_client)
+    # With the task queue enabled agents and their sessions live in the Celery
+    # workers, which prewarm their own (see tasks.py)
+    if TASK_QUEUE_ENABLED:
+        return
+    startup_tasks = [asyncio.create_task(_session_cleanup_loop())]
+    if PREWARM_SESSIONS > 0:
+        startup_tasks.append(asyncio.create_task(_prewarm_sessions()))
+    for task in startup_tasks:
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+async def _reply_twiml(from_number: str, session_id: str, message_body: str, deadline: float) -> str:
+    """
+    Run the agent for one message and return the TwiML to answer the webhook with.
+    A reply ready after `deadline` (event loop time) is sent through the REST API
+    instead, since Twilio has stopped waiting for the webhook response by then.
+    """
+    # Acknowledge right away and let a worker reply, so slow LLM calls can't
+    # run past Twilio's webhook timeout
+    if TASK_QUEUE_ENABLED:
+        # send_task does a blocking broker round-trip, so keep it off the event loop
+        await asyncio.to_thread(
+            celery_app.send_task, "tasks.run_agent", args=(session_id, from_number, message_body), task_id=uuid4().hex
+        )
+        return _EMPTY_TWIML
+    
+    # --- UNIFIED AGENT LOGIC ---
+    # Get or create agent for this user
+    # The whole turn holds the session's lock: the agent and its memory aren't
+    # thread-safe, and one user's messages should be answered in order
+    async with _session_lock(session_id):
+        agent = await asyncio.to_thread(get_or_create_agent, session_id)
+        
+        # Get a response for every message (routed straight to a tool when possible).
+        # The LLM call blocks, so run it off the event loop.
+        async with _LLM_SEM:
+            response_text = (await asyncio.to_thread(respond, agent, message_body)).strip()
+        await asyncio.to_thread(save_session, session_id)
+    late = asyncio.get_running_loop().time() > deadline
+    
+    # --- CREATE TWIML RESPONSE ---
+    # Check if the agent's response contains a URL
+    media_url = extract_url_from_text(response_text)
+    
+    if media_url:
+        # Send a message with only the media, no body text.
+        logger.info("Response: Media URL - %s", media_url)
+        if late:
+            _send_in_background(_send_media(from_number, media_url))
+            return _EMPTY_TWIML
+        return _media_message_twiml(media_url)
+    
+    # It's a regular text response, split if necessary
+    response_chunks = split_message(response_text)
+    logger.info("Response: Text - %s", response_text)
+    
+    if len(response_chunks) == 1 and not late:
+        # Common case: one text message, rendered without building the TwiML tree
+        return _single_message_twiml(response_chunks[0])
+    
+    # Several chunks: acknowledge now and send each chunk through the REST API,
+    # so the webhook response doesn't wait on Twilio delivering every message
+    _send_in_background(_send_chunks(from_number, response_chunks))
+    return _EMPTY_TWIML
 
 @app.post("/whatsapp_webhook")
 async def webhook(request: Request):
     """Main webhook endpoint for Twilio WhatsApp messages."""
     try:
+        deadline = asyncio.get_running_loop().time() + WEBHOOK_REPLY_DEADLINE
         # Parse form data from Twilio
         form_data = await request.form()
         
         # Extract message details
-        from_number = form_data.get("From", "").replace("whatsapp:", "")
+        from_raw = form_data.get("From", "")
+        from_number = from_raw.removeprefix("whatsapp:")
+        session_id = "whatsapp_" + from_number
         message_body = form_data.get("Body", "").strip()
         
-        print(f"Received message from {from_number}: {message_body}")
-        
-        # --- UNIFIED AGENT LOGIC ---
-        # Get or create agent for this user
-        session_id = get_session_id(from_number)
-        if session_id not in session_memory_map:
-            agent = create_agent_for_user(session_id)
-            session_memory_map[session_id] = {"agent": agent}
-        else:
-            agent = session_memory_map[session_id]["agent"]
-        
-        # Get agent response for every message
-        response = agent.chat(message_body)
-        response_text = response.response.strip()
-        
-        # --- CREATE TWIML RESPONSE ---
-        twiml = MessagingResponse()
-        
-        # Check if the agent's response contains a URL
-        media_url = extract_url_from_text(response_text)
+        logger.info("Received message from %s: %s", from_number, message_body)
         
-        if media_url:
-            # Send a message with only the media, no body text.
-            msg = twiml.message()
-            msg.media(media_url)
-            print(f"Response: Media URL - {media_url}")
-        else:
-            # It's a regular text response, split if necessary
-            response_chunks = split_message(response_text)
-            for chunk in response_chunks:
-                twiml.message(chunk)
-            print(f"Response: Text - {response_text}")
+        # Twilio retries a webhook that timed out or failed; answer retries from cache,
+        # waiting for the first request's reply if it is still running
+        cache_key = reply_cache_key(form_data.get("MessageSid"), session_id, message_body)
+        if not await claim_reply(cache_key):
+            content = await wait_for_reply(cache_key)
+            logger.info("Replaying cached reply for %s", from_number)
+            return Response(content=content or _EMPTY_TWIML, media_type="application/xml")
         
-        return Response(content=str(twiml), media_type="application/xml")
+        try:
+            content = await _reply_twiml(from_number, session_id, message_body, deadline)
+        except Exception:
+            await release_reply(cache_key)
+            raise
+        await cache_reply(cache_key, content)
+        return Response(content=content, media_type="application/xml")
             
     except Exception as e:
-        print(f"Error processing webhook: {e}")
+        logger.exception("Error processing webhook: %s", e)
         # Return a simple error response
-        twiml = MessagingResponse()
-        twiml.message("Sorry, I'm having trouble processing your request. Please try again.")
-        return Response(content=str(twiml), media_type="application/xml")
+        return Response(content=_ERROR_TWIML, media_type="application/xml")
 
 if __name__ == "__main__":
     import uvicorn
+    # Single process for local runs. For several workers use the uvicorn CLI
+    # (see README_WHATSAPP.md), which imports the app only in the workers.
     uvicorn.run(app, host="0.0.0.0", port=5000)